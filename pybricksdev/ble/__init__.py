@@ -102,7 +102,7 @@ class BLEConnection:
             data (bytes):
                 Bytes to process.
         """
-        logger.debug("DATA {0}".format(data))
+        logger.debug("DATA %r", data)
 
     def disconnected_handler(self, client: BleakClient):
         """Handles disconnected event."""
@@ -140,15 +140,14 @@ class BLEConnection:
                 Write with or without response.
         """
         # Send the chunks one by one
-        for c in chunk(data, self.max_data_size):
-            logger.debug(
-                "TX CHUNK: {0}, {1} response".format(
-                    c, "with" if with_response else "without"
+        for c in chunk(memoryview(data), self.max_data_size):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "TX CHUNK: %r, %s response",
+                    bytes(c),
+                    "with" if with_response else "without",
                 )
-            )
-            await self.client.write_gatt_char(
-                self.char_rx_UUID, bytearray(c), with_response
-            )
+            await self.client.write_gatt_char(self.char_rx_UUID, c, with_response)
 
 
 class BLERequestsConnection(BLEConnection):
@@ -174,7 +173,7 @@ class BLERequestsConnection(BLEConnection):
             data (bytes):
                 Bytes to process.
         """
-        logger.debug("DATA {0}".format(data))
+        logger.debug("DATA %r", data)
         self.reply = data
         self.reply_ready.set()
 
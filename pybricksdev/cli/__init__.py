@@ -114,8 +114,12 @@ class Compile(Tool):
     async def run(self, args: argparse.Namespace):
         from ..compile import compile_file, print_mpy
 
+        # stdin is copied to a new temporary file each time, so caching
+        # would only fill up the cache
+        use_cache = args.file is not sys.stdin
+
         with _get_script_path(args.file) as script_path:
-            mpy = await compile_file(script_path, args.abi)
+            mpy = await compile_file(script_path, args.abi, use_cache=use_cache)
         print_mpy(mpy)
 
 
@@ -176,6 +180,8 @@ class Run(Tool):
         from ..connections.lego import REPLHub
         from ..connections.pybricks import PybricksHub
 
+        run_args = {}
+
         # Pick the right connection
         if args.conntype == "ssh":
             # So it's an ev3dev
@@ -191,6 +197,10 @@ class Run(Tool):
             print(f"Searching for {args.name or 'any hub with Pybricks service'}...")
             device_or_address = await find_device(args.name)
 
+            # stdin is copied to a new temporary file each time, so caching
+            # would only fill up the cache
+            run_args["use_cache"] = args.file is not sys.stdin
+
         elif args.conntype == "usb":
             hub = REPLHub()
             device_or_address = None
@@ -201,7 +211,7 @@ class Run(Tool):
         await hub.connect(device_or_address)
         try:
             with _get_script_path(args.file) as script_path:
-                await hub.run(script_path, args.wait)
+                await hub.run(script_path, args.wait, **run_args)
         finally:
             await hub.disconnect()
 
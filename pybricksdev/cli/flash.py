@@ -117,7 +117,9 @@ async def download_and_run(client: BleakClient, script: str, abi: int) -> None:
         # file has to be closed so mpy-cross can open it
         temp.file.close()
 
-        mpy = await compile_file(temp.name, abi)
+        # the temporary file name is different each time, so caching
+        # would only fill up the cache
+        mpy = await compile_file(temp.name, abi, use_cache=False)
 
     recv_queue = asyncio.Queue()
 
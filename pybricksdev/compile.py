@@ -2,13 +2,18 @@
 # Copyright (c) 2019-2023 The Pybricks Authors
 
 import asyncio
+import hashlib
 import logging
 import os
+import tempfile
+from importlib.metadata import PackageNotFoundError, version
 from modulefinder import ModuleFinder
+from pathlib import Path
 from typing import List, Optional, Tuple, Union
 
 import mpy_cross_v5
 import mpy_cross_v6
+from appdirs import user_cache_dir
 
 from .tools import chunk
 
@@ -18,6 +23,16 @@ BUILD_DIR = "build"
 TMP_PY_SCRIPT = "_tmp.py"
 TMP_MPY_SCRIPT = "_tmp.mpy"
 
+MPY_CACHE_DIR = Path(user_cache_dir("pybricksdev"), "mpy")
+"""
+Directory where compiled scripts are cached.
+"""
+
+MPY_CACHE_MAX_FILES = 256
+"""
+Maximum number of compiled scripts kept in the cache.
+"""
+
 
 def make_build_dir():
     # Create build folder if it does not exist
@@ -29,7 +44,92 @@ def make_build_dir():
         raise FileExistsError("A file named build already exists.")
 
 
-async def compile_file(path: str, abi: int, compile_args: Optional[List[str]] = None):
+def _get_mpy_cache_path(
+    path: Union[str, os.PathLike],
+    script: str,
+    abi: int,
+    compile_args: Optional[List[str]],
+) -> Optional[Path]:
+    """
+    Gets the path where the compiled script would be cached.
+
+    Returns:
+        The path or ``None`` if the MPY ABI version is not supported.
+    """
+    try:
+        compiler_version = version(f"mpy-cross-v{abi}")
+    except PackageNotFoundError:
+        return None
+
+    # the path is part of the key since mpy-cross stores it in the .mpy file
+    key = hashlib.blake2b(digest_size=16)
+
+    for part in (
+        os.fspath(path),
+        str(abi),
+        compiler_version,
+        repr(compile_args),
+        script,
+    ):
+        key.update(part.encode())
+        key.update(b"\0")
+
+    return MPY_CACHE_DIR / f"{key.hexdigest()}.mpy"
+
+
+def _save_mpy_cache(cache_path: Path, mpy: bytes) -> None:
+    """
+    Saves a compiled script to the cache.
+
+    Failing to write to the cache is not considered an error.
+    """
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # write to a temporary file first so that readers never see a
+        # partially written file
+        with tempfile.NamedTemporaryFile(
+            dir=cache_path.parent, suffix=".tmp", delete=False
+        ) as f:
+            f.write(mpy)
+
+        os.replace(f.name, cache_path)
+    except OSError as e:
+        logger.debug("failed to save %s: %s", cache_path, e)
+        return
+
+    _prune_mpy_cache()
+
+
+def _prune_mpy_cache() -> None:
+    """
+    Removes the least recently used files when the cache has grown larger than
+    :data:`MPY_CACHE_MAX_FILES`.
+    """
+    entries = []
+
+    for p in MPY_CACHE_DIR.glob("*.mpy"):
+        try:
+            entries.append((p.stat().st_mtime, p))
+        except OSError:
+            # may have been removed by another process
+            pass
+
+    entries.sort()
+
+    for _, p in entries[: max(0, len(entries) - MPY_CACHE_MAX_FILES)]:
+        try:
+            p.unlink()
+        except OSError as e:
+            logger.debug("failed to remove %s: %s", p, e)
+
+
+async def compile_file(
+    path: str,
+    abi: int,
+    compile_args: Optional[List[str]] = None,
+    use_cache: bool = True,
+):
     """Compiles a Python file with ``mpy-cross``.
 
     Arguments:
@@ -39,6 +139,9 @@ async def compile_file(path: str, abi: int, compile_args: Optional[List[str]] =
             Expected MPY ABI version.
         compile_args:
             Extra arguments for ``mpy-cross``.
+        use_cache:
+            If true, a previously compiled result is used if the script,
+            path, options and ``mpy-cross`` version are the same.
 
     Returns:
         The compiled script in MPY format.
@@ -54,6 +157,24 @@ async def compile_file(path: str, abi: int, compile_args: Optional[List[str]] =
         loop = asyncio.get_running_loop()
         script = f.read()
 
+        cache_path = (
+            _get_mpy_cache_path(path, script, abi, compile_args) if use_cache else None
+        )
+
+        if cache_path is not None:
+            try:
+                mpy = cache_path.read_bytes()
+            except OSError:
+                pass
+            else:
+                # mark as recently used so that it isn't pruned
+                try:
+                    os.utime(cache_path)
+                except OSError:
+                    pass
+
+                return mpy
+
         if abi == 5:
             proc, mpy = await loop.run_in_executor(
                 None,
@@ -73,10 +194,15 @@ async def compile_file(path: str, abi: int, compile_args: Optional[List[str]] =
 
         proc.check_returncode()
 
+        if cache_path is not None:
+            _save_mpy_cache(cache_path, mpy)
+
         return mpy
 
 
-async def compile_multi_file(path: str, abi: Union[int, Tuple[int, int]]):
+async def compile_multi_file(
+    path: str, abi: Union[int, Tuple[int, int]], use_cache: bool = True
+):
     """Compiles a Python file and its dependencies with ``mpy-cross``.
 
     On the hub, all dependencies behave as independent modules. Any (leading)
@@ -103,6 +229,9 @@ async def compile_multi_file(path: str, abi: Union[int, Tuple[int, int]]):
         abi:
             Expected MPY ABI version. Can be major version (int) if no native
             .mpy modules or tuple of major, minor version.
+        use_cache:
+            If true, previously compiled results are used for files that
+            have not changed. See :func:`compile_file`.
 
     Returns:
         Concatenation of all compiled files in the format given above.
@@ -129,7 +258,7 @@ async def compile_multi_file(path: str, abi: Union[int, Tuple[int, int]]):
     for name, module in finder.modules.items():
         if not module.__file__:
             continue
-        mpy = await compile_file(module.__file__, abi_major)
+        mpy = await compile_file(module.__file__, abi_major, use_cache=use_cache)
 
         parts.append(len(mpy).to_bytes(4, "little"))
         parts.append(name.encode() + b"\x00")
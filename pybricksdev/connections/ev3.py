@@ -151,7 +151,7 @@ class EV3Bootloader:
         num = self._send_command(Command.BEGIN_DOWNLOAD, param_data)
         self._receive_reply(Command.BEGIN_DOWNLOAD, num)
 
-        for c in chunk(data, self._MAX_DATA_SIZE):
+        for c in chunk(memoryview(data), self._MAX_DATA_SIZE):
             num = self._send_command(Command.DOWNLOAD_DATA, c)
             self._receive_reply(Command.DOWNLOAD_DATA, num)
 
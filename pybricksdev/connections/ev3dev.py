@@ -4,9 +4,62 @@
 import asyncio
 import os
 import pathlib
+import weakref
+from typing import Dict, Tuple
 
 import asyncssh
 
+_SFTP_BLOCK_SIZE = 64 * 1024
+"""
+Size of each SFTP write request if the server limits are not known. OpenSSH
+``sftp-server`` rejects messages larger than 256 KiB (including headers) so
+this must stay below that.
+"""
+
+_SFTP_MAX_REQUESTS = 64
+"""
+Maximum number of SFTP write requests in flight at the same time.
+"""
+
+
+class _SSHPool:
+    """
+    SSH connections shared by :class:`EV3Connection` instances.
+
+    Connections and the lock belong to the event loop they were created in,
+    so there is one pool per event loop.
+    """
+
+    def __init__(self) -> None:
+        self.clients: Dict[Tuple[str, str], asyncssh.SSHClientConnection] = {}
+        """Shared connections, keyed by address and username."""
+
+        self.refs: Dict[Tuple[str, str], int] = {}
+        """Number of :class:`EV3Connection` instances using each connection."""
+
+        self.lock = asyncio.Lock()
+
+
+_SSH_POOLS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _SSHPool]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _get_pool() -> _SSHPool:
+    loop = asyncio.get_running_loop()
+
+    # created on first use so that the lock belongs to the running event loop
+    try:
+        return _SSH_POOLS[loop]
+    except KeyError:
+        pool = _SSH_POOLS[loop] = _SSHPool()
+        return pool
+
+
+def _is_alive(client: asyncssh.SSHClientConnection) -> bool:
+    # REVISIT: is_closed() is not available in all supported asyncssh versions
+    return client._transport is not None
+
 
 class EV3Connection:
     """ev3dev SSH connection for running pybricks-micropython scripts.
@@ -33,13 +86,42 @@ class EV3Connection:
                 Connect failed.
         """
 
-        print("Connecting to", address, "...", end=" ")
-        self.client = await asyncssh.connect(
-            address, username=self._USER, password=self._PASSWORD
-        )
-        print("Connected.", end=" ")
-        self.client.sftp = await self.client.start_sftp_client()
-        await self.client.sftp.chdir(self._HOME)
+        key = (address, self._USER)
+
+        # Reuse the SSH connection if another instance is already connected
+        # to the same EV3 so that we only need to open a new SFTP channel.
+        pool = _get_pool()
+
+        async with pool.lock:
+            client = pool.clients.get(key)
+
+            if client is None or not _is_alive(client):
+                print("Connecting to", address, "...", end=" ")
+                client = await asyncssh.connect(
+                    address, username=self._USER, password=self._PASSWORD
+                )
+                print("Connected.", end=" ")
+                pool.clients[key] = client
+                pool.refs[key] = 0
+
+            pool.refs[key] += 1
+
+        self._pool_key = key
+        self.client = client
+
+        try:
+            self.sftp = await self.client.start_sftp_client()
+
+            try:
+                await self.sftp.chdir(self._HOME)
+            except BaseException:
+                self.sftp.exit()
+                raise
+        except BaseException:
+            # don't keep the shared connection open for this instance
+            await self._release_client()
+            raise
+
         print("Opened SFTP.")
 
     async def beep(self):
@@ -47,9 +129,56 @@ class EV3Connection:
         await self.client.run("beep")
 
     async def disconnect(self):
-        """Closes the connection."""
-        self.client.sftp.exit()
-        self.client.close()
+        """Closes the connection.
+
+        The underlying SSH connection is only closed once all other instances
+        connected to the same EV3 have disconnected too.
+        """
+        self.sftp.exit()
+        await self._release_client()
+
+    async def _release_client(self):
+        """Releases this instance's reference to the shared SSH connection."""
+        pool = _get_pool()
+
+        async with pool.lock:
+            if pool.clients.get(self._pool_key) is not self.client:
+                # the shared connection was dropped and replaced in the mean time
+                self.client.close()
+                return
+
+            pool.refs[self._pool_key] -= 1
+
+            if pool.refs[self._pool_key] == 0:
+                del pool.clients[self._pool_key]
+                del pool.refs[self._pool_key]
+                self.client.close()
+
+    @staticmethod
+    async def close_all():
+        """Closes all shared SSH connections of the running event loop.
+
+        This can be used at shutdown in case some connections were never
+        disconnected.
+        """
+        pool = _get_pool()
+
+        async with pool.lock:
+            for client in pool.clients.values():
+                client.close()
+
+            pool.clients.clear()
+            pool.refs.clear()
+
+    def _sftp_block_size(self) -> int:
+        """Gets the largest SFTP write size that the server accepts."""
+        # REVISIT: limits is not available in all supported asyncssh versions
+        limits = getattr(self.sftp, "limits", None)
+
+        if limits is None or not limits.max_write_len:
+            return _SFTP_BLOCK_SIZE
+
+        return limits.max_write_len
 
     async def download(self, local_path):
         """Downloads a file to the EV3 Brick using sftp.
@@ -61,7 +190,12 @@ class EV3Connection:
         """
         # Send script to EV3
         remote_path = self.abs_path(pathlib.Path(local_path).name)
-        await self.client.sftp.put(local_path, remote_path)
+        await self.sftp.put(
+            local_path,
+            remote_path,
+            block_size=self._sftp_block_size(),
+            max_requests=_SFTP_MAX_REQUESTS,
+        )
         return remote_path
 
     async def run(self, local_path, wait=True):
@@ -85,15 +219,15 @@ class EV3Connection:
 
         # Run process asynchronously and print output as it comes in
         async with self.client.create_process(prog) as process:
-            # Keep going until the process is done
-            while process.exit_status is None and wait:
-                try:
-                    line = await asyncio.wait_for(
-                        process.stderr.readline(), timeout=0.1
-                    )
-                    print(line.strip())
-                except asyncio.TimeoutError:
-                    pass
+            if not wait:
+                return
+
+            # Print lines as they arrive until stderr is closed when the
+            # process exits
+            async for line in process.stderr:
+                print(line.strip())
+
+            await process.wait()
 
     async def get(self, remote_path, local_path=None):
         """Gets a file from the EV3 over sftp.
@@ -106,4 +240,4 @@ class EV3Connection:
         """
         if local_path is None:
             local_path = remote_path
-        await self.client.sftp.get(self.abs_path(remote_path), localpath=local_path)
+        await self.sftp.get(self.abs_path(remote_path), localpath=local_path)
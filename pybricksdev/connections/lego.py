@@ -3,14 +3,18 @@
 
 import asyncio
 import os
+import threading
+from collections import deque
+from typing import Deque, Union
 
-from serial import Serial
+from serial import Serial, SerialException
 from serial.tools import list_ports
 
 from ..tools import chunk
 from .pybricks import PybricksHub
 
-FILE_PACKET_SIZE = 1024
+FILE_PACKET_SIZE = 4096
+FILE_TRANSFER_WINDOW = 2
 FILE_TRANSFER_SCRIPT = f"""
 import sys
 import micropython
@@ -18,7 +22,7 @@ import utime
 
 PACKETSIZE = {FILE_PACKET_SIZE}
 
-def receive_file(filename, filesize):
+def receive_file(filename, filesize, packetsize=PACKETSIZE):
 
     micropython.kbd_intr(-1)
 
@@ -26,13 +30,13 @@ def receive_file(filename, filesize):
 
         # Initialize buffers
         done = 0
-        buf = bytearray(PACKETSIZE)
+        buf = bytearray(packetsize)
         sys.stdin.buffer.read(1)
 
         while done < filesize:
 
             # Size of last package
-            if filesize - done < PACKETSIZE:
+            if filesize - done < packetsize:
                 buf = bytearray(filesize - done)
 
             # Read one packet from standard in.
@@ -56,17 +60,23 @@ class REPLHub:
 
     EOL = b"\r\n"  # MicroPython EOL
 
+    _COMPACT_THRESHOLD = 65536
+    """Number of parsed bytes after which they are dropped from the buffer."""
+
     def __init__(self):
+        self.log_file = None
         self.reset_buffers()
 
     def reset_buffers(self):
         """Resets internal buffers that track (parsed) serial data."""
         self.print_output = False
         self.output = []
-        self.buffer = b""
-        self.log_file = None
+        self.buffer = bytearray()
+        self._close_log_file()
         try:
-            self.serial.read(self.serial.in_waiting)
+            # discard anything that was received but not parsed yet
+            while not self._rx_queue.empty():
+                self._rx_queue.get_nowait()
         except AttributeError:
             pass
 
@@ -89,21 +99,68 @@ class REPLHub:
         print("Connecting to {0}".format(port))
         self.serial = Serial(port)
         self.serial.read(self.serial.in_waiting)
+
+        # Serial data is read in a background thread so that we can await
+        # new data instead of polling for it.
+        self._rx_queue = asyncio.Queue()
+        self._stop_reading = threading.Event()
+        self._reader_thread = threading.Thread(
+            target=self._read_serial, args=(asyncio.get_running_loop(),), daemon=True
+        )
+        self._reader_thread.start()
         print("Connected!")
 
     async def disconnect(self):
         """Disconnects from the hub."""
+        self._stop_reading.set()
+        self.serial.cancel_read()
+        self._reader_thread.join()
         self.serial.close()
+        self._close_log_file()
+
+    def _read_serial(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Reads serial data and passes it to the event loop.
+
+        This runs in a background thread until :meth:`disconnect` is called.
+        """
+        while not self._stop_reading.is_set():
+            try:
+                # block until at least one byte is available, then take
+                # everything else that is waiting too
+                data = self.serial.read(max(1, self.serial.in_waiting))
+            except SerialException as e:
+                # pass the error on so that anyone waiting for data gets it
+                loop.call_soon_threadsafe(self._rx_queue.put_nowait, e)
+                return
+
+            if data:
+                loop.call_soon_threadsafe(self._rx_queue.put_nowait, data)
+
+    def _append_input(self, data: Union[bytes, Exception]) -> None:
+        if isinstance(data, Exception):
+            raise data
 
-    def parse_input(self):
-        """Reads waiting serial data and parse as needed."""
-        data = self.serial.read(self.serial.in_waiting)
         self.buffer += data
 
+    def parse_input(self):
+        """Adds serial data that was received so far to the buffer."""
+        while not self._rx_queue.empty():
+            self._append_input(self._rx_queue.get_nowait())
+
+    async def _receive(self):
+        """Waits for more serial data and adds it to the buffer."""
+        self._append_input(await self._rx_queue.get())
+        self.parse_input()
+
+    async def _wait_for_bytes(self, size):
+        """Waits until the buffer contains at least ``size`` bytes."""
+        while len(self.buffer) < size:
+            await self._receive()
+
     def is_idle(self, key=b">>> "):
         """Checks if REPL is ready for a new command."""
         self.parse_input()
-        return self.buffer[-len(key) :] == key
+        return self.buffer.endswith(key)
 
     async def reset_hub(self):
         """Soft resets the hub to clear MicroPython variables."""
@@ -144,11 +201,9 @@ class REPLHub:
         self.serial.write(echo)
 
         # Wait until the echo has been read.
-        while len(self.buffer) < start_len + len(echo):
-            await asyncio.sleep(0.05)
-            self.parse_input()
+        await self._wait_for_bytes(start_len + len(echo))
         # Raise error if we did not get the echo back.
-        if echo not in self.buffer[start_len:]:
+        if self.buffer.find(echo, start_len) < 0:
             print(start_len, self.buffer, self.buffer[start_len - 1 :], echo)
             raise ValueError("Failed to execute line: {0}.".format(line))
 
@@ -158,9 +213,10 @@ class REPLHub:
 
         # Wait for MicroPython to execute the command.
         while not self.is_idle():
-            await asyncio.sleep(0.1)
+            await self._receive()
 
     line_handler = PybricksHub._line_handler
+    _close_log_file = PybricksHub._close_log_file
 
     async def exec_paste_mode(self, code, wait=True, print_output=True):
         """Executes commands via paste mode."""
@@ -175,21 +231,19 @@ class REPLHub:
         # Enter paste mode.
         self.serial.write(b"\x05")
         while not self.is_idle(key=b"=== "):
-            await asyncio.sleep(0.1)
+            await self._receive()
 
         # Paste the script, chunk by chunk to avoid overrun
         start_len = len(self.buffer)
         echo = encoded + b"\r\n"
 
-        for c in chunk(echo, 200):
+        for c in chunk(memoryview(echo), 200):
             self.serial.write(c)
             # Wait until the pasted code is echoed back.
-            while len(self.buffer) < start_len + len(c):
-                await asyncio.sleep(0.05)
-                self.parse_input()
+            await self._wait_for_bytes(start_len + len(c))
 
             # If it isn't, then stop.
-            if c not in self.buffer[start_len:]:
+            if self.buffer.find(c, start_len) < 0:
                 print(start_len, self.buffer, self.buffer[start_len - 1 :], echo)
                 raise ValueError("Failed to paste: {0}.".format(code))
 
@@ -208,21 +262,23 @@ class REPLHub:
 
         # Look for output while the program runs
         while not self.is_idle():
-            # Keep parsing hub data.
-            self.parse_input()
-
             # Look for completed lines that we haven't parsed yet.
-            next_line_index = self.buffer.find(self.EOL, line_index)
-
-            if next_line_index >= 0:
-                # If a new line is found, parse it.
-                self.line_handler(self.buffer[line_index:next_line_index])
+            while (next_line_index := self.buffer.find(self.EOL, line_index)) >= 0:
+                self.line_handler(bytes(self.buffer[line_index:next_line_index]))
                 line_index = next_line_index + len(self.EOL)
-            await asyncio.sleep(0.1)
+
+            # Drop lines that have already been parsed so that the buffer
+            # doesn't keep growing while the program runs.
+            if line_index > self._COMPACT_THRESHOLD:
+                del self.buffer[:line_index]
+                line_index = 0
+
+            # Wait for more hub data.
+            await self._receive()
 
         # Parse remaining hub data.
         while (next_line_index := self.buffer.find(self.EOL, line_index)) >= 0:
-            self.line_handler(self.buffer[line_index:next_line_index])
+            self.line_handler(bytes(self.buffer[line_index:next_line_index]))
             line_index = next_line_index + len(self.EOL)
 
     async def run(self, py_path, wait=True, print_output=True):
@@ -232,8 +288,27 @@ class REPLHub:
         await self.reset_hub()
         await self.exec_paste_mode(script, wait, print_output)
 
-    async def upload_file(self, destination, contents):
-        """Uploads a file to the hub."""
+    async def upload_file(
+        self,
+        destination,
+        contents,
+        packet_size=FILE_PACKET_SIZE,
+        window=FILE_TRANSFER_WINDOW,
+    ):
+        """Uploads a file to the hub.
+
+        Arguments:
+            destination (str):
+                Path of the file on the hub.
+            contents (bytes):
+                The file data.
+            packet_size (int):
+                Number of bytes the hub receives before sending an
+                acknowledgement.
+            window (int):
+                Number of packets that may be sent before waiting for an
+                acknowledgement.
+        """
 
         # Print upload info.
         size = len(contents)
@@ -241,27 +316,43 @@ class REPLHub:
         self.reset_buffers()
 
         # Prepare hub to receive file
-        await self.exec_line(f"receive_file('{destination}', {size})", wait=False)
+        await self.exec_line(
+            f"receive_file('{destination}', {size}, {packet_size})", wait=False
+        )
 
         ACK = b"ACK" + self.EOL
         progress = 0
 
-        # Write file chunk by chunk.
-        for data in chunk(contents, FILE_PACKET_SIZE):
-            # Send a chunk and wait for acknowledgement of receipt
-            buffer_now = len(self.buffer)
-            progress += self.serial.write(data)
-            while len(self.buffer) < buffer_now + len(ACK):
-                await asyncio.sleep(0.01)
-                self.parse_input()
+        # Where to look for the next acknowledgement and sizes of packets
+        # that have not been acknowledged yet.
+        ack_index = len(self.buffer)
+        pending: Deque[int] = deque()
+
+        async def wait_for_ack():
+            nonlocal ack_index, progress
+
+            await self._wait_for_bytes(ack_index + len(ACK))
 
             # Raise error if we didn't get acknowledgement
-            if self.buffer[buffer_now : buffer_now + len(ACK)] != ACK:
-                print(self.buffer[buffer_now:])
+            if self.buffer[ack_index : ack_index + len(ACK)] != ACK:
+                print(self.buffer[ack_index:])
                 raise ValueError("Did not get expected response from the hub.")
 
+            ack_index += len(ACK)
+            progress += pending.popleft()
+
             # Print progress
             print(f"Progress: {int(progress / size * 100)}%", end="\r")
 
+        # Write file chunk by chunk, keeping up to window chunks in flight.
+        for data in chunk(memoryview(contents), packet_size):
+            if len(pending) >= window:
+                await wait_for_ack()
+
+            pending.append(self.serial.write(data))
+
+        while pending:
+            await wait_for_ack()
+
         # Get REPL back in normal state
         await self.exec_line("# File transfer complete")
@@ -3,13 +3,20 @@
 
 import asyncio
 import contextlib
+import hashlib
 import logging
 import os
+import queue
+import re
 import struct
-from typing import Awaitable, List, Optional, TypeVar
+import tempfile
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Awaitable, Deque, Iterator, List, Optional, Tuple, TypeVar
 
-import reactivex.operators as op
 import semver
+from appdirs import user_cache_dir
 from bleak import BleakClient
 from bleak.backends.device import BLEDevice
 from packaging.version import Version
@@ -43,6 +50,130 @@ logger = logging.getLogger(__name__)
 
 T = TypeVar("T")
 
+PROGRAM_HASH_DIR = Path(user_cache_dir("pybricksdev"), "programs")
+"""
+Directory where hashes of the last program downloaded to each hub are saved.
+"""
+
+_LOG_SENTINEL_RE = re.compile(rb"(?:PB_OF:|_file_begin_ )(.*)|PB_EOF|_file_end_", re.S)
+"""
+Matches hub output lines that open (with the path in group 1) or close a log file.
+"""
+
+_LEGACY_DOWNLOAD_WINDOW = 4
+"""
+Initial number of unacknowledged blocks allowed when downloading a program
+to a hub with legacy firmware.
+"""
+
+_LEGACY_DOWNLOAD_MAX_WINDOW = 8
+"""
+Maximum number of unacknowledged blocks allowed when downloading a program
+to a hub with legacy firmware.
+"""
+
+
+def _make_legacy_download_blocks(mpy: bytes) -> List[Tuple[bytes, int]]:
+    """
+    Splits a program into the blocks sent when downloading to a hub with
+    legacy firmware.
+
+    The first block is the size of the program. It is followed by the program
+    itself in blocks of 100 bytes or less.
+
+    Args:
+        mpy: The compiled program.
+
+    Returns:
+        List of each block and its checksum.
+    """
+    blocks = [len(mpy).to_bytes(4, byteorder="little")]
+    blocks.extend(chunk(memoryview(mpy), 100))
+    return [(b, xor_bytes(b, 0)) for b in blocks]
+
+
+def _hash_program(program: bytes) -> str:
+    """
+    Gets the hash that identifies a downloaded program.
+    """
+    return hashlib.blake2b(program, digest_size=8).hexdigest()
+
+
+class _LogFileWriter:
+    """
+    Writes lines to a file in a background thread so that the caller is not
+    blocked by disk I/O.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "wb")
+        # None is used as a sentinel to stop the thread
+        self._queue: "queue.Queue[Optional[bytes]]" = queue.Queue(maxsize=4096)
+        # error raised by the background thread, if any
+        self._error: Optional[Exception] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write_line(self, line: bytes) -> None:
+        """
+        Queues a line to be written to the file.
+
+        This only blocks if the background thread has fallen far behind.
+
+        Raises:
+            OSError: if writing a previous line failed.
+        """
+        if self._error is not None:
+            raise self._error
+
+        self._queue.put(line)
+
+    def close(self) -> None:
+        """
+        Writes all queued lines and closes the file.
+
+        Raises:
+            OSError: if writing or closing the file failed.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+    def _run(self) -> None:
+        done = False
+
+        try:
+            with self._file:
+                while not done:
+                    # wait for at least one item, then take everything else
+                    # that is waiting so that it can be written all at once
+                    batch = [self._queue.get()]
+
+                    try:
+                        while True:
+                            batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        pass
+
+                    # the sentinel is always the last item since nothing is
+                    # queued after close()
+                    done = batch[-1] is None
+
+                    if done:
+                        batch.pop()
+
+                    if batch:
+                        self._file.write(b"\n".join(batch) + b"\n")
+        except Exception as e:
+            self._error = e
+
+            # keep taking lines until close() so that callers are never
+            # blocked by a full queue, they get the error instead
+            while not done:
+                done = self._queue.get() is None
+
 
 class PybricksHub:
     EOL = b"\r\n"  # MicroPython EOL
@@ -82,7 +213,7 @@ class PybricksHub:
         self.connection_state_observable = BehaviorSubject(ConnectionState.DISCONNECTED)
         self.status_observable = BehaviorSubject(StatusFlag(0))
         self._stdout_subject = Subject()
-        self.nus_observable = Subject()
+        self._nus_listeners: List[asyncio.Queue] = []
         self.print_output = True
         self.fw_version = None
         self._mpy_abi_version = 0
@@ -92,8 +223,8 @@ class PybricksHub:
         # whether to enable line handler features or not
         self._enable_line_handler = False
 
-        # buffered stdout from the hub for splitting into lines
-        self._stdout_buf = bytearray()
+        # buffered partial line of stdout from the hub for splitting into lines
+        self._stdout_buf = b""
 
         # REVISIT: this can potentially waste a lot of RAM if not drained
         self._stdout_line_queue = asyncio.Queue()
@@ -127,6 +258,32 @@ class PybricksHub:
         """
         return self._stdout_subject
 
+    @contextlib.contextmanager
+    def subscribe_nus(self) -> Iterator["asyncio.Queue[bytes]"]:
+        """
+        Context manager to receive all data from the Nordic UART service.
+
+        Yields:
+            A queue that receives each notification until the context exits.
+        """
+        queue: asyncio.Queue[bytes] = asyncio.Queue()
+        self._nus_listeners.append(queue)
+
+        try:
+            yield queue
+        finally:
+            self._nus_listeners.remove(queue)
+
+    def _close_log_file(self) -> None:
+        """
+        Closes the log file, if any, after writing all lines that are still
+        queued.
+        """
+        log_file, self.log_file = self.log_file, None
+
+        if log_file is not None:
+            log_file.close()
+
     def _line_handler(self, line: bytes) -> None:
         """
         Handles new incoming lines. Handle special actions if needed,
@@ -136,40 +293,39 @@ class PybricksHub:
             line: Line to process.
         """
 
+        match = _LOG_SENTINEL_RE.search(line)
+
         # The line tells us to open a log file, so do it.
-        if b"PB_OF:" in line or b"_file_begin_ " in line:
+        if match and match.group(1) is not None:
             if self.log_file is not None:
                 raise RuntimeError("Log file is already open!")
 
-            path_start = len(b"PB_OF:") if b"PB_OF:" in line else len(b"_file_begin_ ")
-
             # Get path relative to running script, so log will go
             # in the same folder unless specified otherwise.
-            full_path = os.path.join(self.script_dir, line[path_start:].decode())
+            full_path = os.path.join(self.script_dir, match.group(1).decode())
             dir_path, _ = os.path.split(full_path)
             if not os.path.exists(dir_path):
                 os.makedirs(dir_path)
 
-            logger.info("Saving log to {0}.".format(full_path))
-            self.log_file = open(full_path, "w")
+            logger.info("Saving log to %s.", full_path)
+            self.log_file = _LogFileWriter(full_path)
             return
 
         # The line tells us to close a log file, so do it.
-        if b"PB_EOF" in line or b"_file_end_" in line:
+        if match:
             if self.log_file is None:
                 raise RuntimeError("No log file is currently open!")
             logger.info("Done saving log.")
-            self.log_file.close()
-            self.log_file = None
+            self._close_log_file()
             return
 
-        line_str = line.decode()
-
         # If we are processing datalog, save current line to the open file.
         if self.log_file is not None:
-            print(line_str, file=self.log_file)
+            self.log_file.write_line(line)
             return
 
+        line_str = line.decode()
+
         self.output.append(line)
 
         if self.print_output:
@@ -179,26 +335,17 @@ class PybricksHub:
         self._stdout_line_queue.put_nowait(line_str)
 
     def _handle_line_data(self, data: bytes) -> None:
-        self._stdout_buf.extend(data)
-
-        # Break up data into lines and take those out of the buffer
-        lines = []
-        while True:
-            # Find and split at end of line
-            index = self._stdout_buf.find(self.EOL)
-            # If no more line end is found, we are done
-            if index < 0:
-                break
-            # If we found a line, save it, and take it from the buffer
-            lines.append(self._stdout_buf[:index])
-            del self._stdout_buf[: index + len(self.EOL)]
+        # Break up data into lines. The last item is whatever is left after
+        # the last line ending (possibly empty), so it is kept for next time.
+        *lines, self._stdout_buf = (self._stdout_buf + data).split(self.EOL)
 
         # Call handler for each line that we found
         for line in lines:
             self._line_handler(line)
 
     def _nus_handler(self, sender, data: bytearray) -> None:
-        self.nus_observable.on_next(data)
+        for listener in self._nus_listeners:
+            listener.put_nowait(data)
 
         # legacy firmware may use NUS for download and run, in which case
         # we need to ignore the incoming data
@@ -238,7 +385,7 @@ class PybricksHub:
                 Information Service)
             RuntimeError: if Pybricks Protocol version is not supported
         """
-        logger.info(f"Connecting to {device.name}")
+        logger.info("Connecting to %s", device.name)
 
         if self.connection_state_observable.value != ConnectionState.DISCONNECTED:
             raise RuntimeError(
@@ -311,15 +458,21 @@ class PybricksHub:
     async def disconnect(self):
         logger.info("Disconnecting...")
 
-        if self.connection_state_observable.value == ConnectionState.CONNECTED:
-            self.connection_state_observable.on_next(ConnectionState.DISCONNECTING)
-            await self.client.disconnect()
-            # ConnectionState.DISCONNECTED should be set by disconnect callback
-            assert (
-                self.connection_state_observable.value == ConnectionState.DISCONNECTED
-            )
-        else:
-            logger.debug("skipping disconnect because not connected")
+        try:
+            if self.connection_state_observable.value == ConnectionState.CONNECTED:
+                self.connection_state_observable.on_next(ConnectionState.DISCONNECTING)
+                await self.client.disconnect()
+                # ConnectionState.DISCONNECTED should be set by disconnect callback
+                assert (
+                    self.connection_state_observable.value
+                    == ConnectionState.DISCONNECTED
+                )
+            else:
+                logger.debug("skipping disconnect because not connected")
+        finally:
+            # save anything that was logged by a program that didn't close
+            # its log file
+            self._close_log_file()
 
     async def race_disconnect(self, awaitable: Awaitable[T]) -> T:
         """
@@ -451,6 +604,10 @@ class PybricksHub:
                 f"program is too big ({len(program)} bytes). Hub has limit of {self._max_user_program_size} bytes."
             )
 
+        # the hub won't have the old program anymore if the download fails
+        # part way through
+        self._save_program_hash(None)
+
         # clear user program meta so hub doesn't try to run invalid program
         await self.client.write_gatt_char(
             PYBRICKS_COMMAND_EVENT_UUID,
@@ -485,6 +642,8 @@ class PybricksHub:
             response=True,
         )
 
+        self._save_program_hash(_hash_program(program))
+
     async def start_user_program(self) -> None:
         """
         Starts the user program that is already in RAM on the hub.
@@ -513,6 +672,9 @@ class PybricksHub:
         wait: bool = True,
         print_output: bool = True,
         line_handler: bool = True,
+        skip_unchanged: bool = False,
+        legacy_download_window: int = _LEGACY_DOWNLOAD_WINDOW,
+        use_cache: bool = True,
     ) -> None:
         """
         Compiles and runs a user program.
@@ -523,14 +685,26 @@ class PybricksHub:
             wait: If true, wait for the user program to stop before returning.
             print_output: If true, echo stdout of the hub to ``sys.stdout``.
             line_handler: If true enable hub stdout line handler features.
+            skip_unchanged: If true, don't download the program if it is the
+                same as the last program downloaded to this hub from this
+                computer. The hub can't be queried for its program, so this
+                should only be used if nothing else downloads programs to
+                the hub.
+            legacy_download_window: The initial number of blocks that may be
+                sent before waiting for the hub to acknowledge them when
+                downloading to hubs with older firmware (Pybricks profile
+                < 1.2.0). This grows as blocks are acknowledged.
+            use_cache: If false, the program is always compiled again instead
+                of using the cache of compiled programs. See
+                :func:`pybricksdev.compile.compile_file`.
         """
         if self.connection_state_observable.value != ConnectionState.CONNECTED:
             raise RuntimeError("not connected")
 
         # Reset output buffer
-        self.log_file = None
+        self._close_log_file()
         self.output = []
-        self._stdout_buf.clear()
+        self._stdout_buf = b""
         self._stdout_line_queue = asyncio.Queue()
         self.print_output = print_output
         self._enable_line_handler = line_handler
@@ -544,7 +718,7 @@ class PybricksHub:
                 raise RuntimeError(
                     "Hub does not support running stored program. Provide a py_path to run"
                 )
-            await self._legacy_run(py_path, wait)
+            await self._legacy_run(py_path, wait, legacy_download_window, use_cache)
             return
 
         # since Pybricks profile v1.2.0, the hub will tell us which file format(s) it supports
@@ -569,71 +743,186 @@ class PybricksHub:
             abi = (6, 1)
 
         if py_path is not None:
-            mpy = await compile_multi_file(py_path, abi)
-            await self.download_user_program(mpy)
+            mpy = await compile_multi_file(py_path, abi, use_cache=use_cache)
+
+            if skip_unchanged and self._is_program_downloaded(mpy):
+                logger.info("Program is unchanged, skipping download.")
+            else:
+                await self.download_user_program(mpy)
 
         await self.start_user_program()
 
         if wait:
             await self._wait_for_user_program_stop()
 
-    async def _legacy_run(self, py_path: str, wait: bool) -> None:
+    def _is_program_downloaded(self, program: bytes) -> bool:
+        """
+        Checks if the program is the last one downloaded to the connected hub
+        by :meth:`download_user_program`.
+        """
+        return self._read_program_hash() == _hash_program(program)
+
+    def _program_hash_path(self) -> Path:
+        # addresses contain ":" which is not allowed in file names on Windows
+        return PROGRAM_HASH_DIR / f"last_hash_{self.client.address.replace(':', '')}"
+
+    def _read_program_hash(self) -> Optional[str]:
+        """
+        Reads the hash of the last program downloaded to the connected hub.
+
+        Returns:
+            The hash or ``None`` if it is not known.
+        """
+        try:
+            return self._program_hash_path().read_text()
+        except OSError:
+            return None
+
+    def _save_program_hash(self, program_hash: Optional[str]) -> None:
+        """
+        Saves the hash of the last program downloaded to the connected hub.
+
+        Args:
+            program_hash: The hash or ``None`` to forget the saved hash.
+        """
+        path = self._program_hash_path()
+
+        try:
+            if program_hash is None:
+                path.unlink(missing_ok=True)
+                return
+
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+            # replace the file in one step so that it is never partially written
+            with tempfile.NamedTemporaryFile(
+                "w", dir=path.parent, suffix=".tmp", delete=False
+            ) as f:
+                f.write(program_hash)
+
+            os.replace(f.name, path)
+        except OSError as e:
+            # not fatal, the program will just be downloaded next time
+            logger.debug("failed to save program hash: %s", e)
+
+    async def _legacy_run(
+        self,
+        py_path: str,
+        wait: bool,
+        window: int = _LEGACY_DOWNLOAD_WINDOW,
+        use_cache: bool = True,
+    ) -> None:
         """
         Version of :meth:`run` for compatibility with older firmware ()
+
+        Args:
+            py_path: The path to the .py file to compile.
+            wait: If true, wait for the user program to stop before returning.
+            window: The initial number of blocks that may be sent before
+                waiting for the hub to acknowledge them. This grows up to
+                ``_LEGACY_DOWNLOAD_MAX_WINDOW`` as blocks are acknowledged.
+            use_cache: If false, don't use the cache of compiled programs.
         """
+        if window < 1:
+            raise ValueError("window must be at least 1")
+
         # Compile the script to mpy format
-        mpy = await compile_file(py_path, self._mpy_abi_version)
+        mpy = await compile_file(py_path, self._mpy_abi_version, use_cache=use_cache)
+
+        # The length of the file is sent first, then the data in blocks of
+        # 100 bytes or less. In order to prevent sending data to the hub faster
+        # than it can be processed, we wait for the hub to send a checksum to
+        # acknowledge each block. Several blocks may be in flight at once to
+        # avoid waiting for a round trip for every block.
+        blocks = await asyncio.get_running_loop().run_in_executor(
+            None, _make_legacy_download_blocks, mpy
+        )
+
+        # index and expected checksum of blocks that have not been acknowledged
+        in_flight: Deque[Tuple[int, int]] = deque()
+        credits = asyncio.Semaphore(window)
 
         try:
             self._downloading_via_nus = True
 
-            queue: asyncio.Queue[bytes] = asyncio.Queue()
-            subscription = self.nus_observable.subscribe(
-                lambda data: queue.put_nowait(data)
-            )
-
             async def send_block(data: bytes) -> None:
                 """
-                In order to prevent sending data to the hub faster than it can
-                be processed, it is sent in blocks of 100 bytes or less. Then
-                we wait for the hub to send a checksum to acknowledge that it
-                has processed the data.
+                Sends a block of data without waiting for acknowledgement.
 
                 Args:
                     data: The data to send (100 bytes or less).
                 """
                 if self.hub_kind == HubKind.BOOST:
                     # BOOST Move hub has fixed MTU of 23 so we can only send 20
-                    # bytes at a time
-                    for c in chunk(data, 20):
-                        await self.client.write_gatt_char(NUS_RX_UUID, c, False)
+                    # bytes at a time. These are writes without response, so
+                    # they are all issued at once instead of one at a time.
+                    # gather() starts the writes in the order given.
+                    await asyncio.gather(
+                        *(
+                            self.client.write_gatt_char(NUS_RX_UUID, c, False)
+                            for c in chunk(data, 20)
+                        )
+                    )
                 else:
                     await self.client.write_gatt_char(NUS_RX_UUID, data, False)
 
-                msg = await asyncio.wait_for(
-                    self.race_disconnect(queue.get()), timeout=0.5
-                )
-                actual_checksum = msg[0]
-                expected_checksum = xor_bytes(data, 0)
+            async def send_blocks() -> None:
+                for i, (data, checksum) in enumerate(blocks):
+                    await credits.acquire()
+                    # must be queued before writing since the reply could
+                    # be received before the write returns
+                    in_flight.append((i, checksum))
+                    await send_block(data)
 
-                if actual_checksum != expected_checksum:
-                    raise RuntimeError(
-                        f"bad checksum: expecting {hex(expected_checksum)} but received {hex(actual_checksum)}"
-                    )
+            async def receive_acks(pbar: tqdm) -> None:
+                current_window = window
+                acked = 0
+
+                while acked < len(blocks):
+                    msg = await asyncio.wait_for(queue.get(), timeout=0.5)
+
+                    # more than one checksum may arrive in a single notification
+                    for actual_checksum in msg:
+                        if not in_flight:
+                            raise RuntimeError("received unexpected checksum")
+
+                        i, expected_checksum = in_flight.popleft()
+
+                        if actual_checksum != expected_checksum:
+                            raise RuntimeError(
+                                f"bad checksum: expecting {hex(expected_checksum)} but received {hex(actual_checksum)}"
+                            )
+
+                        acked += 1
 
-            # Get length of file and send it as bytes to hub
-            length = len(mpy).to_bytes(4, byteorder="little")
-            await send_block(length)
+                        # the first block is the length, not part of the file
+                        if i:
+                            pbar.update(len(blocks[i][0]))
 
-            # Send the data chunk by chunk
-            with logging_redirect_tqdm(), tqdm(
+                        credits.release()
+
+                        # each time a full window is acknowledged without
+                        # errors, allow one more block to be in flight
+                        if (
+                            acked % current_window == 0
+                            and current_window < _LEGACY_DOWNLOAD_MAX_WINDOW
+                        ):
+                            current_window += 1
+                            credits.release()
+
+            with self.subscribe_nus() as queue, logging_redirect_tqdm(), tqdm(
                 total=len(mpy), unit="B", unit_scale=True
             ) as pbar:
-                for c in chunk(mpy, 100):
-                    await send_block(c)
-                    pbar.update(len(c))
+                sender = asyncio.ensure_future(send_blocks())
+                receiver = asyncio.ensure_future(receive_acks(pbar))
+
+                try:
+                    await self.race_disconnect(asyncio.gather(sender, receiver))
+                finally:
+                    # if one fails, don't leave the other one running
+                    sender.cancel()
+                    receiver.cancel()
         finally:
-            subscription.dispose()
             self._downloading_via_nus = False
 
         if wait:
@@ -641,11 +930,19 @@ class PybricksHub:
 
     async def _wait_for_user_program_stop(self):
         user_program_running: asyncio.Queue[bool] = asyncio.Queue()
+        last_running: Optional[bool] = None
+
+        def handle_status(status: StatusFlag) -> None:
+            nonlocal last_running
+
+            # only queue changes of the running flag
+            running = bool(status & StatusFlag.USER_PROGRAM_RUNNING)
+
+            if running != last_running:
+                last_running = running
+                user_program_running.put_nowait(running)
 
-        with self.status_observable.pipe(
-            op.map(lambda s: bool(s & StatusFlag.USER_PROGRAM_RUNNING)),
-            op.distinct_until_changed(),
-        ).subscribe(lambda s: user_program_running.put_nowait(s)):
+        with self.status_observable.subscribe(handle_status):
             # The first item in the queue is the current status. The status
             # could change before or after the last checksum is received,
             # so this could be either true or false.
@@ -8,7 +8,6 @@ Utilities for working with Pybricks ``firmware.zip`` files.
 import io
 import json
 import os
-import struct
 import sys
 import zipfile
 from typing import BinaryIO, List, Literal, Optional, Tuple, TypedDict, Union
@@ -21,6 +20,7 @@ else:
 import semver
 
 from .compile import compile_file, save_script
+from .tools import U32
 from .tools.checksum import crc32_checksum, sum_complement
 
 
@@ -142,16 +142,19 @@ async def _create_firmware_v1(
     else:
         mpy = b""
 
-    # start with base firmware binary blob
-    firmware = bytearray(base)
-    # pad with 0s until user-mpy-offset
-    firmware.extend(0 for _ in range(metadata["user-mpy-offset"] - len(firmware)))
-    # append 32-bit little-endian main.mpy file size
-    firmware.extend(struct.pack("<I", len(mpy)))
-    # append main.mpy file
-    firmware.extend(mpy)
-    # pad with 0s to align to 4-byte boundary
-    firmware.extend(0 for _ in range(-len(firmware) % 4))
+    mpy_offset = max(metadata["user-mpy-offset"], len(base))
+    # main.mpy size and file, padded with 0s to align to 4-byte boundary
+    checksum_offset = mpy_offset + 4 + len(mpy)
+    checksum_offset += -checksum_offset % 4
+
+    # allocate the whole image, including the checksum, up front
+    firmware = bytearray(checksum_offset + 4)
+    # start with base firmware binary blob, padded with 0s until user-mpy-offset
+    firmware[: len(base)] = base
+    # 32-bit little-endian main.mpy file size
+    U32.pack_into(firmware, mpy_offset, len(mpy))
+    # main.mpy file
+    firmware[mpy_offset + 4 : mpy_offset + 4 + len(mpy)] = mpy
 
     # Update hub name if given
     if name:
@@ -173,15 +176,20 @@ async def _create_firmware_v1(
         firmware[offset : offset + len(name)] = name
 
     # Get checksum for this firmware
-    if metadata["checksum-type"] == "sum":
-        checksum = sum_complement(io.BytesIO(firmware), metadata["max-firmware-size"])
-    elif metadata["checksum-type"] == "crc32":
-        checksum = crc32_checksum(io.BytesIO(firmware), metadata["max-firmware-size"])
-    else:
-        raise ValueError(f"unsupported checksum type: {metadata['checksum-type']}")
+    with memoryview(firmware) as view:
+        if metadata["checksum-type"] == "sum":
+            checksum = sum_complement(
+                view[:checksum_offset], metadata["max-firmware-size"]
+            )
+        elif metadata["checksum-type"] == "crc32":
+            checksum = crc32_checksum(
+                io.BytesIO(view[:checksum_offset]), metadata["max-firmware-size"]
+            )
+        else:
+            raise ValueError(f"unsupported checksum type: {metadata['checksum-type']}")
 
-    # Append checksum to the firmware
-    firmware.extend(struct.pack("<I", checksum))
+    # Fill in checksum at the end of the firmware
+    U32.pack_into(firmware, checksum_offset, checksum)
 
     return firmware
 
@@ -213,7 +221,7 @@ async def _create_firmware_v2(
 
     # Get checksum for this firmware
     if metadata["checksum-type"] == "sum":
-        checksum = sum_complement(io.BytesIO(firmware), metadata["checksum-size"])
+        checksum = sum_complement(firmware, metadata["checksum-size"])
     elif metadata["checksum-type"] == "crc32":
         checksum = crc32_checksum(io.BytesIO(firmware), metadata["checksum-size"])
     elif (
@@ -225,7 +233,7 @@ async def _create_firmware_v2(
         raise ValueError(f"unsupported checksum type: {metadata['checksum-type']}")
 
     # Append checksum to the firmware
-    firmware.extend(struct.pack("<I", checksum))
+    firmware += U32.pack(checksum)
 
     return firmware
 
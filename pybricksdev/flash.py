@@ -2,12 +2,12 @@
 # Copyright (c) 2019-2022 The Pybricks Authors
 
 import asyncio
-import io
 import logging
 import platform
 import struct
 from collections import namedtuple
-from typing import Dict, List, Optional, Tuple
+from types import MappingProxyType
+from typing import List, Mapping, Optional, Tuple
 
 from tqdm.auto import tqdm
 from tqdm.contrib.logging import logging_redirect_tqdm
@@ -15,16 +15,30 @@ from tqdm.contrib.logging import logging_redirect_tqdm
 from .ble import BLERequestsConnection
 from .ble.lwp3.bootloader import BootloaderCommand
 from .ble.lwp3.bytecodes import HubKind
+from .tools import U32
 
 logger = logging.getLogger(__name__)
 
 
 # NAME, PAYLOAD_SIZE requirement
-HUB_INFO: Dict[HubKind, Tuple[str, int]] = {
-    HubKind.BOOST: ("Move Hub", 14),
-    HubKind.CITY: ("City Hub", 32),
-    HubKind.TECHNIC: ("Technic Hub", 32),
-}
+#
+# The payload size is what the bootloader accepts per PROGRAM_FLASH message,
+# not something that depends on the negotiated MTU, so it can't be raised on
+# connections with a larger MTU. Move Hub is limited to 14 bytes because it
+# only supports the default MTU of 23 (20 byte writes).
+HUB_INFO: Mapping[HubKind, Tuple[str, int]] = MappingProxyType(
+    {
+        HubKind.BOOST: ("Move Hub", 14),
+        HubKind.CITY: ("City Hub", 32),
+        HubKind.TECHNIC: ("Technic Hub", 32),
+    }
+)
+
+FLASH_QUEUE_DEPTH = 10
+"""Number of firmware chunks sent between checksum requests while flashing."""
+
+# size, address header of PROGRAM_FLASH payloads
+_FLASH_HDR = struct.Struct("<BI")
 
 
 class BootloaderRequest:
@@ -40,22 +54,23 @@ class BootloaderRequest:
         write_with_response: bool = True,
     ):
         self.command = command
+        self._prefix = bytes((command,))
         self.ReplyClass = namedtuple(name, request_format)
         self.data_format = data_format
-        self.reply_len = struct.calcsize(data_format)
+        self._reply_struct = struct.Struct(data_format)
+        self.reply_len = self._reply_struct.size
         if request_reply:
             self.reply_len += 1
         self.write_with_response = write_with_response
 
-    def make_request(self, payload: Optional[bytes] = None) -> bytearray:
-        request = bytearray([self.command])
-        if payload is not None:
-            request += payload
-        return request
+    def make_request(self, payload: Optional[bytes] = None) -> bytes:
+        if payload is None:
+            return self._prefix
+        return self._prefix + payload
 
     def parse_reply(self, reply) -> namedtuple:
         if reply[0] == self.command:
-            return self.ReplyClass(*struct.unpack(self.data_format, reply[1:]))
+            return self.ReplyClass(*self._reply_struct.unpack_from(reply, 1))
         else:
             raise ValueError(
                 f"Expecting reply to {self.command.name} but received {BootloaderCommand(reply[0]).name}"
@@ -168,9 +183,19 @@ class BootloaderConnection(BLERequestsConnection):
                 reply = await self.wait_for_reply(timeout)
             return request.parse_reply(reply)
 
-    async def flash(self, firmware, metadata):
+    async def flash(self, firmware, metadata, queue_depth=FLASH_QUEUE_DEPTH):
+        """Flashes firmware on the hub.
+
+        Arguments:
+            firmware (bytes):
+                The firmware binary.
+            metadata (dict):
+                The firmware metadata.
+            queue_depth (int):
+                Number of chunks that are sent before waiting for the hub to
+                catch up.
+        """
         # Firmware information
-        firmware_io = io.BytesIO(firmware)
         firmware_size = len(firmware)
 
         # Request hub information
@@ -181,7 +206,8 @@ class BootloaderConnection(BLERequestsConnection):
         # Hub specific settings
         hub_name, max_data_size = HUB_INFO[info.type_id]
 
-        # Verify hub ID against ID in firmware package
+        # Verify hub ID against ID in firmware package. This has to happen
+        # before erasing so that the wrong firmware never wipes the hub.
         if info.type_id != metadata["device-id"]:
             await self.disconnect()
             raise RuntimeError(
@@ -211,7 +237,7 @@ class BootloaderConnection(BLERequestsConnection):
         # Get the bootloader ready to accept the firmware
         logger.debug("Request begin update.")
         response = await self.bootloader_request(
-            request=self.INIT_LOADER, payload=struct.pack("<I", firmware_size)
+            request=self.INIT_LOADER, payload=U32.pack(firmware_size)
         )
         logger.debug(response)
         logger.debug("Begin update.")
@@ -220,45 +246,77 @@ class BootloaderConnection(BLERequestsConnection):
         with logging_redirect_tqdm(), tqdm(
             total=firmware_size, unit="B", unit_scale=True
         ) as pbar:
-
-            def reader():
-                while True:
-                    payload = firmware_io.read(max_data_size)
-                    if not payload:
-                        return
-                    yield payload
-
-            address = info.start_addr
-
-            # Repeat until the whole firmware has been processed
-            for i, payload in enumerate(reader()):
-                # Since there is no feedback from the hub when writing the
-                # firmware data, we need to periodically do something to get
-                # a response back from the hub. We use the checksum command
-                # for this as a hack. This throttles the speed of sending data
-                # to a rate that can be handled by both the sender and the hub.
-                if i % 10 == 9:
-                    result = await self.bootloader_request(
-                        self.GET_CHECKSUM, timeout=0.5
-                    )
-                    logger.debug(result)
-
-                # Check if this is the last chunk to be sent
-                if firmware_io.tell() == firmware_size:
-                    # If so, request flash with confirmation request.
-                    request = self.PROGRAM_FLASH_FINAL
-                else:
-                    # Otherwise, do not wait for confirmation.
-                    request = self.PROGRAM_FLASH
-
-                # Pack the data in the expected format
-                data = struct.pack(
-                    f"<BI{len(payload)}B", len(payload) + 4, address, *payload
-                )
-                response = await self.bootloader_request(request, data)
-                logger.debug(response)
-                pbar.update(len(payload))
-                address += len(payload)
+            # Writes of chunks that don't get a reply are not awaited one by
+            # one so that several of them can be sent per connection event.
+            pending: List[asyncio.Future] = []
+            checksum_request: Optional[asyncio.Future] = None
+
+            # These chunks are assembled in place, using one slot for each
+            # chunk that can be pending, instead of allocating new buffers.
+            slot_size = 1 + _FLASH_HDR.size + max_data_size
+            tx_buf = memoryview(bytearray(queue_depth * slot_size))
+            fw_buf = memoryview(firmware)
+
+            try:
+                # Repeat until the whole firmware has been processed
+                for i, offset in enumerate(range(0, firmware_size, max_data_size)):
+                    payload = fw_buf[offset : offset + max_data_size]
+                    address = info.start_addr + offset
+
+                    # Since there is no feedback from the hub when writing the
+                    # firmware data, we need to periodically do something to
+                    # get a response back from the hub. We use the checksum
+                    # command for this as a hack. This throttles the speed of
+                    # sending data to a rate that can be handled by both the
+                    # sender and the hub. The reply is only awaited at the
+                    # next checksum request so that sending can continue while
+                    # the hub is busy with the previous chunks.
+                    if i % queue_depth == queue_depth - 1:
+                        if checksum_request:
+                            logger.debug(await checksum_request)
+                        await asyncio.gather(*pending)
+                        pending.clear()
+                        checksum_request = asyncio.ensure_future(
+                            self.bootloader_request(self.GET_CHECKSUM, timeout=0.5)
+                        )
+
+                    # Check if this is the last chunk to be sent
+                    if offset + len(payload) == firmware_size:
+                        # If so, request flash with confirmation request.
+                        if checksum_request:
+                            logger.debug(await checksum_request)
+                            checksum_request = None
+                        await asyncio.gather(*pending)
+                        pending.clear()
+                        response = await self.bootloader_request(
+                            self.PROGRAM_FLASH_FINAL,
+                            _FLASH_HDR.pack(len(payload) + 4, address) + payload,
+                        )
+                        logger.debug(response)
+                    else:
+                        # Otherwise, do not wait for confirmation.
+                        start = i % queue_depth * slot_size
+                        end = start + 1 + _FLASH_HDR.size + len(payload)
+                        tx_buf[start] = self.PROGRAM_FLASH.command
+                        _FLASH_HDR.pack_into(
+                            tx_buf, start + 1, len(payload) + 4, address
+                        )
+                        tx_buf[start + 1 + _FLASH_HDR.size : end] = payload
+                        pending.append(
+                            asyncio.ensure_future(
+                                self.write(
+                                    tx_buf[start:end],
+                                    self.PROGRAM_FLASH.write_with_response,
+                                )
+                            )
+                        )
+
+                    pbar.update(len(payload))
+            finally:
+                if checksum_request:
+                    checksum_request.cancel()
+                for f in pending:
+                    f.cancel()
 
         # Reboot the hub
         logger.debug("Request reboot.")
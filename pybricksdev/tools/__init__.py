@@ -1,10 +1,16 @@
 # SPDX-License-Identifier: MIT
 # Copyright (c) 2021 The Pybricks Authors
 
+import struct
 from typing import Generator, Sequence, TypeVar
 
 T = TypeVar("T")
 
+U32 = struct.Struct("<I")
+"""
+Packs and unpacks 32-bit little-endian unsigned integers.
+"""
+
 
 def chunk(data: Sequence[T], size: int) -> Generator[Sequence[T], None, None]:
     """
@@ -23,4 +29,4 @@ def chunk(data: Sequence[T], size: int) -> Generator[Sequence[T], None, None]:
         yield data[i : i + size]
 
 
-__all__ = ["chunk"]
+__all__ = ["chunk", "U32"]
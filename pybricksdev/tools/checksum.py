@@ -5,6 +5,8 @@
 Helper functions for calculating checksums.
 """
 
+import sys
+from array import array
 from io import BytesIO
 
 
@@ -19,15 +21,20 @@ def xor_bytes(data: bytes, init: int = 0xFF) -> int:
     Returns:
         The calculated checksum.
     """
-    checksum = init
+    # Treat the data as one big integer and fold it in half repeatedly so that
+    # the xor is done by int operations instead of a loop over each byte.
+    size = len(data)
+    value = int.from_bytes(data, "little")
 
-    for b in data:
-        checksum ^= b
+    while size > 1:
+        half = size // 2
+        value = (value >> (half * 8)) ^ (value & ((1 << (half * 8)) - 1))
+        size -= half
 
-    return checksum
+    return init ^ value
 
 
-def sum_complement(data: BytesIO, max_size: int) -> int:
+def sum_complement(data: bytes, max_size: int) -> int:
     """
     Calculates the checksum of using the sum complement method of adding each
     32-bit word (little-endian) and the returning the two's complement as the
@@ -35,33 +42,38 @@ def sum_complement(data: BytesIO, max_size: int) -> int:
 
     Arguments:
         data:
-            A binary buffer - e.g. a file opened in 'rb' mode.
+            The binary data. If the length is not a multiple of 4 bytes, it
+            is treated as if it was padded with zeros.
         max_size:
             The maximum size of the firmware file.
 
     Returns:
         The correction needed to make the checksum == 0.
     """
-    checksum = 0
-    size = 0
+    data = memoryview(data).cast("B")
 
-    while True:
-        word = data.read(4)
-        if not word:
-            break
-        checksum += int.from_bytes(word, "little")
-        size += 4
+    # the last partial word, if any, is summed separately instead of copying
+    # all of the data to pad it
+    whole = len(data) & ~3
+    size = whole if whole == len(data) else whole + 4
 
     if size + 4 > max_size:
         raise ValueError("data is too large")
 
-    for _ in range(size, max_size - 4, 4):
-        checksum += 0xFFFFFFFF
+    # array does the conversion to 32-bit words in C ("I" is 32 bits on all
+    # supported platforms)
+    words = array("I")
+    words.frombytes(data[:whole])
+
+    if sys.byteorder == "big":
+        words.byteswap()
+
+    checksum = sum(words) + int.from_bytes(data[whole:], "little")
 
-    checksum &= 0xFFFFFFFF
-    correction = checksum and (1 << 32) - checksum or 0
+    # unused space up to the checksum word is counted as 0xFFFFFFFF words
+    checksum += len(range(size, max_size - 4, 4)) * 0xFFFFFFFF
 
-    return correction
+    return -checksum & 0xFFFFFFFF
 
 
 # thanks https://stackoverflow.com/a/33152544/1976323
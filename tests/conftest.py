@@ -0,0 +1,13 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2023 The Pybricks Authors
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def user_cache_dirs(tmp_path, monkeypatch):
+    """Keeps tests from writing to the user's cache directory."""
+    monkeypatch.setattr("pybricksdev.compile.MPY_CACHE_DIR", tmp_path / "mpy-cache")
+    monkeypatch.setattr(
+        "pybricksdev.connections.pybricks.PROGRAM_HASH_DIR", tmp_path / "programs"
+    )
@@ -0,0 +1,50 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2023 The Pybricks Authors
+
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+
+from pybricksdev.connections.pybricks import PybricksHub
+
+
+def make_hub() -> PybricksHub:
+    hub = PybricksHub()
+    hub.client = Mock(address="00:11:22:33:44:55")
+    hub.client.write_gatt_char = AsyncMock()
+    hub._max_write_size = 20
+    hub._max_user_program_size = 1000
+    return hub
+
+
+def test_program_hash_unknown():
+    hub = make_hub()
+    assert not hub._is_program_downloaded(b"program")
+
+
+@pytest.mark.asyncio
+async def test_program_hash_after_download():
+    hub = make_hub()
+    await hub.download_user_program(b"program")
+
+    assert hub._is_program_downloaded(b"program")
+    assert not hub._is_program_downloaded(b"other program")
+
+    # a different hub doesn't have the program
+    other_hub = make_hub()
+    other_hub.client.address = "00:11:22:33:44:66"
+    assert not other_hub._is_program_downloaded(b"program")
+
+
+@pytest.mark.asyncio
+async def test_program_hash_failed_download():
+    hub = make_hub()
+    await hub.download_user_program(b"program")
+
+    hub.client.write_gatt_char.side_effect = OSError
+    with pytest.raises(OSError):
+        await hub.download_user_program(b"other program")
+
+    # the hub may not have either program anymore
+    assert not hub._is_program_downloaded(b"program")
+    assert not hub._is_program_downloaded(b"other program")
@@ -1,4 +1,16 @@
-from pybricksdev.tools.checksum import xor_bytes
+import functools
+import operator
+import random
+
+import pytest
+
+from pybricksdev.tools.checksum import sum_complement, xor_bytes
+
+
+def _random_bytes(size: int) -> bytes:
+    # seeded so that failures can be reproduced
+    rng = random.Random(size)
+    return bytes(rng.randrange(256) for _ in range(size))
 
 
 def test_xor_bytes():
@@ -7,3 +19,53 @@ def test_xor_bytes():
     assert xor_bytes(b"\xFF") == 0xFF ^ 0xFF
     assert xor_bytes(b"\xFF", 0x00) == 0x00 ^ 0xFF
     assert xor_bytes(b"\x01\x02\x03\x04") == 0xFF ^ 0x01 ^ 0x02 ^ 0x03 ^ 0x04
+    assert xor_bytes(b"") == 0xFF
+    assert xor_bytes(b"", 0x00) == 0x00
+
+
+@pytest.mark.parametrize("size", [2, 3, 5, 99, 100, 101, 4096])
+def test_xor_bytes_matches_bytewise_xor(size: int):
+    data = _random_bytes(size)
+    assert xor_bytes(data, 0x00) == functools.reduce(operator.xor, data, 0x00)
+    assert xor_bytes(data) == functools.reduce(operator.xor, data, 0xFF)
+
+
+def _sum_complement_reference(data: bytes, max_size: int) -> int:
+    # straightforward implementation to compare against
+    checksum = 0
+
+    for i in range(0, len(data), 4):
+        checksum += int.from_bytes(data[i : i + 4], "little")
+
+    for _ in range((len(data) + 3) // 4 * 4, max_size - 4, 4):
+        checksum += 0xFFFFFFFF
+
+    return -checksum & 0xFFFFFFFF
+
+
+@pytest.mark.parametrize("size", [0, 1, 3, 4, 5, 1024, 4097])
+def test_sum_complement(size: int):
+    data = _random_bytes(size)
+    max_size = 8192
+
+    checksum = sum_complement(data, max_size)
+    assert checksum == _sum_complement_reference(data, max_size)
+
+    # adding the correction word to the padded data makes the sum zero
+    padded = data + bytes(-size % 4)
+    padded += b"\xff" * (max_size - 4 - len(padded))
+    padded += checksum.to_bytes(4, "little")
+    assert sum_complement(padded, max_size + 4) == 0
+
+
+def test_sum_complement_too_large():
+    with pytest.raises(ValueError):
+        sum_complement(bytes(8), 8)
+
+
+def test_sum_complement_memoryview():
+    data = bytearray(_random_bytes(1027))
+
+    assert sum_complement(memoryview(data)[:1022], 8192) == sum_complement(
+        bytes(data[:1022]), 8192
+    )
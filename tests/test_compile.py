@@ -29,3 +29,49 @@ async def test_compile_file(abi: int):
             assert int_bits == 31
         finally:
             os.unlink(f.name)
+
+
+@pytest.mark.asyncio
+async def test_compile_file_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr("pybricksdev.compile.MPY_CACHE_DIR", tmp_path / "cache")
+
+    script = tmp_path / "test.py"
+    script.write_text("print('test')")
+
+    mpy = await compile_file(str(script), abi=6)
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError("should not be called")
+
+    # second call is served from cache
+    monkeypatch.setattr("mpy_cross_v6.mpy_cross_compile", fail)
+    assert await compile_file(str(script), abi=6) == mpy
+
+    # changing the script invalidates the cache
+    script.write_text("print('changed')")
+    with pytest.raises(AssertionError):
+        await compile_file(str(script), abi=6)
+
+    script.write_text("print('test')")
+
+    # path-like objects work the same as strings
+    assert await compile_file(script, abi=6) == mpy
+
+    # cache can be bypassed
+    with pytest.raises(AssertionError):
+        await compile_file(str(script), abi=6, use_cache=False)
+
+
+@pytest.mark.asyncio
+async def test_compile_file_cache_prune(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setattr("pybricksdev.compile.MPY_CACHE_DIR", cache_dir)
+    monkeypatch.setattr("pybricksdev.compile.MPY_CACHE_MAX_FILES", 2)
+
+    for i in range(4):
+        script = tmp_path / f"test{i}.py"
+        script.write_text("print('test')")
+        await compile_file(str(script), abi=6)
+
+    assert len(list(cache_dir.iterdir())) == 2